@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
+import os
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT = pathlib.Path(__file__).resolve().parent  # 视情况调整
 IDS_FILE = ROOT / "qpod_sid73_material_ids.txt"
 CIF_DIR = ROOT / "cif_downloads"
+# download_cifs.py writes a flat CIF_DIR. Set True only if you moved the CIFs
+# into one level of shard subdirectories (e.g. cif_downloads/aa/); every
+# direct subdirectory then counts, and the shards are scanned in parallel.
+SHARDED = False
 MISSING_FILE = ROOT / "missing_ids.txt"
 CASEFIX_SUFFIX = "__casefix-"
+SCAN_WORKERS = 16
 
 def iter_ids(path: pathlib.Path) -> set[str]:
     ids = set()
@@ -16,29 +25,56 @@ def iter_ids(path: pathlib.Path) -> set[str]:
                 ids.add(line)
     return ids
 
+def scan_shard(directory: str | os.PathLike) -> tuple[set[str], list[str]]:
+    """Return CIF stems found directly in directory, plus its subdirectories."""
+    names: set[str] = set()
+    subdirs: list[str] = []
+    # os.scandir reuses the file type from readdir, so no per-file stat call.
+    with os.scandir(directory) as it:
+        for entry in it:
+            name = entry.name
+            if len(name) > 4 and name[-4:].lower() == ".cif" and entry.is_file():
+                stem = name[:-4]
+                if CASEFIX_SUFFIX in stem:
+                    stem = stem.split(CASEFIX_SUFFIX, 1)[0]
+                names.add(stem)
+            elif entry.is_dir():
+                subdirs.append(entry.path)
+    return names, subdirs
+
 def iter_cif_names(directory: pathlib.Path) -> set[str]:
     if not directory.exists():
         return set()
-    names: set[str] = set()
-    for entry in directory.iterdir():
-        if entry.is_file() and entry.suffix.lower() == ".cif":
-            stem = entry.stem
-            if CASEFIX_SUFFIX in stem:
-                stem = stem.split(CASEFIX_SUFFIX, 1)[0]
-            names.add(stem)
+    names, shards = scan_shard(directory)
+    # Shards are listed concurrently; directory reads release the GIL, so
+    # they overlap on the storage queue. Deeper subdirectories are ignored.
+    if SHARDED and shards:
+        with ThreadPoolExecutor(max_workers=min(SCAN_WORKERS, len(shards))) as pool:
+            for shard_names, _ in pool.map(scan_shard, shards):
+                names |= shard_names
     return names
 
+def classify(expected: set[str], actual: set[str]) -> tuple[list[str], list[str]]:
+    """Return sorted (missing, extra) IDs in a single pass; consumes ``actual``."""
+    missing: list[str] = []
+    for mid in expected:
+        try:
+            actual.remove(mid)
+        except KeyError:
+            missing.append(mid)
+    missing.sort()
+    return missing, sorted(actual)  # whatever was not matched is extra
+
 def main() -> None:
     expected = iter_ids(IDS_FILE)
     actual = iter_cif_names(CIF_DIR)
 
-    missing = sorted(expected - actual)
-    extra = sorted(actual - expected)
-
     print(f"Total IDs listed: {len(expected)}")
     print(f"CIF files found:  {len(actual)}")
     print()
 
+    missing, extra = classify(expected, actual)
+
     if missing:
         print("Missing CIFs (IDs with no file):")
         for mid in missing:
@@ -55,8 +91,12 @@ def main() -> None:
     else:
         print("No extra CIF files.")
 
-    MISSING_FILE.write_text("\n".join(missing), encoding="utf-8")
-    print(f"\nMissing IDs saved to {MISSING_FILE}")
+    # Write each missing ID through a large buffer instead of joining one big string.
+    with MISSING_FILE.open("w", encoding="utf-8", buffering=1 << 20) as out:
+        for mid in missing:
+            out.write(mid)
+            out.write("\n")
+    print(f"\n{len(missing)} missing IDs saved to {MISSING_FILE}")
 
 if __name__ == "__main__":
     main()
@@ -2,38 +2,86 @@
 """Deduplicate IDs in qpod_sid73_material_ids.txt while preserving order."""
 from __future__ import annotations
 
+import os
 import pathlib
+import shutil
+
+try:  # Optional Bloom filter; keeps memory flat for very large ID lists
+    from pybloom_live import ScalableBloomFilter
+except ImportError:  # pragma: no cover - fall back to an exact set
+    ScalableBloomFilter = None
 
 IDS_PATH = pathlib.Path(__file__).with_name("qpod_sid73_material_ids.txt")
 BACKUP_PATH = IDS_PATH.with_suffix(".bak")
+TMP_PATH = IDS_PATH.with_suffix(".tmp")
 
 
-def main() -> None:
-    text = IDS_PATH.read_text(encoding="utf-8").splitlines()
+def backup_original() -> None:
+    """Keep the original file as BACKUP_PATH, hard-linking when possible."""
+    BACKUP_PATH.unlink(missing_ok=True)
+    try:
+        os.link(IDS_PATH, BACKUP_PATH)
+    except OSError:
+        shutil.copy2(IDS_PATH, BACKUP_PATH)
+
+
+def collect_repeat_candidates() -> set[str] | None:
+    """Return IDs that may occur more than once, or None without pybloom_live.
+
+    The Bloom filter answers "definitely not seen" for nearly every unique ID,
+    so only repeated IDs (plus rare false positives) are stored exactly.
+    """
+    if ScalableBloomFilter is None:
+        return None
+    bloom = ScalableBloomFilter(initial_capacity=100_000, error_rate=1e-6)
+    candidates: set[str] = set()
+    with IDS_PATH.open("r", encoding="utf-8") as fin:
+        for raw_line in fin:
+            line = raw_line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if line in bloom:
+                candidates.add(line)
+            else:
+                bloom.add(line)
+    return candidates
 
-    # Keep the first occurrence and preserve original order.
+
+def main() -> None:
+    # Only IDs flagged by the Bloom pass need exact tracking; without it,
+    # every ID goes through the exact set.
+    candidates = collect_repeat_candidates()
     seen: set[str] = set()
-    deduped: list[str] = []
-
-    for line in text:
-        if not line.strip():
-            continue
-        if line.startswith("#"):
-            deduped.append(line)
-            continue
-        if line not in seen:
-            seen.add(line)
-            deduped.append(line)
-
-    if deduped == text:
+    changed = False
+    total = 0
+    kept = 0
+
+    with IDS_PATH.open("r", encoding="utf-8") as fin, TMP_PATH.open("w", encoding="utf-8") as fout:
+        for raw_line in fin:
+            total += 1
+            line = raw_line.rstrip("\r\n")
+            if not line.strip():
+                changed = True
+                continue
+            if not line.startswith("#") and (candidates is None or line in candidates):
+                # Keep the first occurrence and preserve original order.
+                if line in seen:
+                    changed = True
+                    continue
+                seen.add(line)
+            fout.write(line + "\n")
+            kept += 1
+
+    if not changed:
+        TMP_PATH.unlink()
         print("No duplicates found; file left unchanged.")
         return
 
-    BACKUP_PATH.write_text("\n".join(text) + "\n", encoding="utf-8")
-    IDS_PATH.write_text("\n".join(deduped) + "\n", encoding="utf-8")
+    backup_original()
+    os.replace(TMP_PATH, IDS_PATH)
 
     print(f"Backup written to {BACKUP_PATH}")
-    print(f"Original lines: {len(text)}, unique lines: {len(deduped)}")
+    print(f"Original lines: {total}, unique lines: {kept}")
 
 
 if __name__ == "__main__":
@@ -1,16 +1,19 @@
 # qpod_extract_material_ids.py
 # 只提取类似 2AgBrSe2-1.Ag_Br.0.1 这样的唯一ID，一行一个
-# Python 3.6+ 即可运行，只需 requests 和 beautifulsoup4
+# Python 3.6+ 即可运行，只需 requests 和 lxml
 
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
 import time
 import os
+import json
 
 # ================== 配置区 ==================
 sid = 73                              # ← 修改这里的 sid 即可
 output_file = f"qpod_sid{sid}_material_ids.txt"   # 输出文件名
+checkpoint_file = f"qpod_sid{sid}_checkpoint.json"  # 断点文件：记录最后完成的页码
 interval = 5                          # 每页间隔秒数（建议 4~6 秒，对服务器友好）
+skip_after_known_pages = 3            # 连续这么多页全部已知时，直接跳到上次抓到的最后一页
 session = requests.Session()
 session.headers.update(
     {
@@ -20,6 +23,14 @@ session.headers.update(
 )
 # ===========================================
 
+
+def save_checkpoint(page, count, done=False):
+    """原子地写入断点：先写临时文件再 os.replace，避免中途崩溃留下半个 JSON"""
+    tmp = checkpoint_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as ck:
+        json.dump({"page": page, "count": count, "done": done}, ck)
+    os.replace(tmp, checkpoint_file)
+
 # 断点续爬：如果文件已存在，读取最后一条ID，避免重复
 existing_ids = set()
 if os.path.exists(output_file):
@@ -30,8 +41,30 @@ if os.path.exists(output_file):
                 existing_ids.add(line)
     print(f"检测到已有 {len(existing_ids)} 条ID，将从上次位置继续...")
 
+# 断点续爬：未完成时从上次完成的页之后开始，避免重新请求之前的页；
+# 上次已全部抓完时从第 1 页重新检查，但连续遇到全部已知的页后直接跳到最后一页
+page = 0
+last_known_page = 0
+if os.path.exists(checkpoint_file):
+    try:
+        with open(checkpoint_file, "r", encoding="utf-8") as ck:
+            checkpoint = json.load(ck)
+        if len(existing_ids) < checkpoint.get("count", 0):
+            # ID 文件被删除或替换：断点之前的页不能跳过
+            print(f"断点记录了 {checkpoint['count']} 条ID，但 {output_file} 只有 {len(existing_ids)} 条，忽略断点，从第 1 页开始...")
+        elif checkpoint.get("done"):
+            last_known_page = checkpoint["page"]
+            print(f"上次已抓完全部 {last_known_page+1} 页，从第 1 页重新检查新增 ID...")
+        else:
+            last_known_page = checkpoint["page"]
+            page = last_known_page + 1
+            print(f"检测到断点文件，从第 {page+1} 页继续...")
+    except (OSError, ValueError, KeyError) as e:
+        print("断点文件无法读取，从第 1 页开始：", e)
+
+known_streak = 0  # 连续全部已知的页数
+
 with open(output_file, "a", encoding="utf-8") as f:
-    page = 0
     while True:
         url = f"https://qpod.fysik.dtu.dk/table?sid={sid}&page={page}"
         print(f"正在抓取第 {page+1} 页 → {url}")
@@ -45,9 +78,13 @@ with open(output_file, "a", encoding="utf-8") as f:
             time.sleep(10)
             continue
 
-        soup = BeautifulSoup(r.text, "html.parser")
-
-        rows = soup.select("tbody tr")
+        # 直接把 bytes 交给 lxml（C 实现，比 html.parser 快很多），由它自行识别编码
+        # 空白响应会让 lxml 抛 ParserError，按“没有数据行”处理
+        try:
+            tree = lxml_html.fromstring(r.content)
+            rows = tree.xpath("//tbody/tr")
+        except etree.ParserError:
+            rows = []
         if not rows:
             print("本页没有数据行，可能是结构变了，打印前500字符排查：")
             print(r.text[:500])
@@ -55,45 +92,59 @@ with open(output_file, "a", encoding="utf-8") as f:
 
         links = []
         for row in rows:
-            anchor = row.select_one("th a[href*='/material/']")
-            if anchor:
-                links.append(anchor)
+            anchors = row.xpath(".//th//a[contains(@href, '/material/')]")
+            if anchors:
+                links.append(anchors[0])
 
         if not links:
             print("没有找到任何 material 链接，打印前500字符排查：")
             print(r.text[:500])
             break
 
-        new_count = 0
-        for a in links:
-            material_id = a["href"].split("/material/")[1]   # 提取 xxx 部分
-            if material_id not in existing_ids:
-                f.write(material_id + "\n")
-                existing_ids.add(material_id)
-                new_count += 1
+        ids_on_page = [a.get("href").split("/material/")[1] for a in links]   # 提取 xxx 部分
+
+        if all(material_id in existing_ids for material_id in ids_on_page):
+            # 整页都已记录：不写文件、不 fsync、不更新断点
+            known_streak += 1
+            print(f"第 {page+1} 页的 ID 均已存在，跳过写入")
+        else:
+            known_streak = 0
+            new_count = 0
+            for material_id in ids_on_page:
+                if material_id not in existing_ids:
+                    f.write(material_id + "\n")
+                    existing_ids.add(material_id)
+                    new_count += 1
 
-        f.flush()
-        os.fsync(f.fileno())
+            f.flush()
+            os.fsync(f.fileno())
+            save_checkpoint(page, len(existing_ids))
 
-        print(f"第 {page+1} 页完成，本页新增 {new_count} 条，累计 {len(existing_ids)} 条")
+            print(f"第 {page+1} 页完成，本页新增 {new_count} 条，累计 {len(existing_ids)} 条")
 
         # 判断是否到最后一页
-        next_btn = soup.find(
-            "a",
-            class_="page-link",
-            string=lambda s: s and s.strip() in [">", "›", "Next"],
+        next_btns = tree.xpath(
+            "//a[contains(concat(' ', normalize-space(@class), ' '), ' page-link ')]"
+            "[normalize-space(.)='>' or normalize-space(.)='›' or normalize-space(.)='Next']"
         )
 
-        if not next_btn:
+        if not next_btns:
             print("没有下一页按钮，结束。")
+            save_checkpoint(page, len(existing_ids), done=True)
             break
 
-        parent_li = next_btn.find_parent("li")
-        if parent_li and "disabled" in parent_li.get("class", []):
+        parent_li = next_btns[0].xpath("ancestor::li[1]")
+        if parent_li and "disabled" in parent_li[0].get("class", "").split():
             print("已到达最后一页！")
+            save_checkpoint(page, len(existing_ids), done=True)
             break
 
-        page += 1
+        if known_streak >= skip_after_known_pages and page + 1 < last_known_page:
+            print(f"连续 {known_streak} 页均已抓取过，直接跳到第 {last_known_page+1} 页")
+            page = last_known_page
+            known_streak = 0
+        else:
+            page += 1
         time.sleep(interval)  # 礼貌等待
 
 print(f"\n全部完成！共 {len(existing_ids)} 条 material ID 已保存到：")
@@ -4,49 +4,94 @@ from __future__ import annotations
 
 import argparse
 import csv
+import os
 import pathlib
-import random
+import queue
 import sys
+import tarfile
 import time
-import urllib.error
-import urllib.request
 import hashlib
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
-from typing import Callable
+from threading import Lock, Thread
+from typing import Callable, TextIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:  # Optional progress bar
     from tqdm import tqdm
 except ImportError:  # pragma: no cover - fallback if tqdm not installed
     tqdm = None
 
+try:  # Optional compressed archive output (--compress)
+    import zstandard as zstd
+except ImportError:  # pragma: no cover - only needed with --compress
+    zstd = None
+
 BASE_URL = "https://qpod.fysik.dtu.dk/material/{id}/download/cif"
+# BASE_URL split around "{id}" so building each URL is plain concatenation.
+_URL_PREFIX, _URL_SUFFIX = BASE_URL.split("{id}")
 DEFAULT_IDS_FILE = pathlib.Path(__file__).with_name("qpod_sid73_material_ids.txt")
 DEFAULT_OUTPUT_DIR = pathlib.Path(__file__).with_name("cif_downloads")
 DEFAULT_LOG_PATH = pathlib.Path(__file__).with_name("download_status.csv")
+CHUNK_SIZE = 64 * 1024
+LOG_HEADER = ("id", "downloaded")
+TRUTHY = {"true", "1", "yes", "y"}
+LOG_FLUSH_EVERY = 64
+
+# Shared across worker threads so HTTPS connections are kept alive and reused.
+SESSION = requests.Session()
+
+def configure_session(pool_size: int) -> None:
+    """Mount a pooled, retrying adapter sized for ``pool_size`` concurrent workers."""
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,  # hand the final response to raise_for_status()
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    SESSION.mount("https://", adapter)
 
-def load_log(log_path: pathlib.Path) -> list[dict[str, str]]:
-    """Return rows already present in log; rows keep original order."""
+def load_log(log_path: pathlib.Path) -> list[tuple[str, bool]]:
+    """Return (id, downloaded) rows already present in log; rows keep original order."""
     if not log_path.exists():
         return []
     try:
         with log_path.open("r", newline="", encoding="utf-8") as handle:
-            return [row for row in csv.DictReader(handle)]
+            reader = csv.reader(handle)
+            next(reader, None)  # header
+            return [
+                (row[0].strip(), len(row) > 1 and row[1].strip().lower() in TRUTHY)
+                for row in reader
+                if row
+            ]
     except OSError as exc:
         print(f"[warn] Unable to read existing log {log_path}: {exc}")
         return []
 
-def write_log(log_path: pathlib.Path, rows: list[dict[str, str]]) -> None:
+def write_log(log_path: pathlib.Path, rows: list[tuple[str, bool]]) -> None:
     """Write rows back to the CSV log (overwrite)."""
     try:
         log_path.parent.mkdir(parents=True, exist_ok=True)
         with log_path.open("w", newline="", encoding="utf-8") as handle:
-            writer = csv.DictWriter(handle, fieldnames=["id", "downloaded"])
-            writer.writeheader()
-            writer.writerows(rows)
+            csv.writer(handle).writerows([LOG_HEADER, *rows])
     except OSError as exc:
         print(f"[warn] Unable to write log file {log_path}: {exc}")
 
+def open_log_appender(log_path: pathlib.Path) -> TextIO | None:
+    """Open the CSV log for appending; write the header if the file is new or empty."""
+    try:
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        handle = log_path.open("a", newline="", encoding="utf-8")
+    except OSError as exc:
+        print(f"[warn] Unable to open log file {log_path}: {exc}")
+        return None
+    if handle.tell() == 0:
+        csv.writer(handle).writerow(LOG_HEADER)
+    return handle
+
 def iter_material_ids(ids_path: pathlib.Path) -> list[str]:
     """Return material IDs read from a text file, ignoring blanks and comments."""
     material_ids: list[str] = []
@@ -63,63 +108,210 @@ def iter_material_ids(ids_path: pathlib.Path) -> list[str]:
         raise SystemExit(f"No material IDs found in {ids_path}.")
     return material_ids
 
+class TokenBucket:
+    """Thread-safe token bucket capping request starts at ``rps`` per second."""
+
+    def __init__(self, rps: float) -> None:
+        self.rate = rps
+        self.capacity = max(1.0, rps)  # allow at most one second of burst
+        self.tokens = self.capacity
+        self.t = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate)
+                self.t = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def preallocate(fd: int, size: int) -> None:
+    """Reserve ``size`` bytes for ``fd`` up front; best effort, no-op where unsupported."""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass  # e.g. filesystems without fallocate support
+
+class CifArchive:
+    """Single zstd-compressed tar stream that worker threads add CIFs to.
+
+    Tar entries are written straight into the zstd stream rather than through
+    tarfile's record buffer, so :meth:`flush` puts every added CIF on disk.
+    After any write error the archive is marked unusable via ``error``.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.lock = Lock()
+        self.error: OSError | None = None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = path.open("xb")
+        cctx = zstd.ZstdCompressor(level=10, threads=-1)
+        self._stream = cctx.stream_writer(self._file, closefd=False)
+        self._offset = 0
+
+    def _fail(self, exc: Exception) -> OSError:
+        self.error = OSError(f"archive {self.path} is unusable ({exc})")
+        return self.error
+
+    def _write(self, data: bytes) -> None:
+        self._stream.write(data)
+        self._offset += len(data)
+
+    def add(self, name: str, data: bytes) -> None:
+        info = tarfile.TarInfo(name=name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        padding = tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE)
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            try:
+                self._write(info.tobuf())
+                self._write(data)
+                self._write(padding)
+            except (OSError, zstd.ZstdError) as exc:
+                raise self._fail(exc) from exc
+
+    def flush(self) -> bool:
+        """Push tar and zstd buffers to disk; return False if the archive is unusable."""
+        with self.lock:
+            if self.error is not None:
+                return False
+            try:
+                self._stream.flush(zstd.FLUSH_BLOCK)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except (OSError, zstd.ZstdError) as exc:
+                self._fail(exc)
+                return False
+            return True
+
+    def close(self) -> None:
+        with self.lock:
+            if self._offset == 0:
+                # Nothing was added (e.g. every download failed): leave no empty archive.
+                self._file.close()
+                self.path.unlink(missing_ok=True)
+                return
+            try:
+                if self.error is None:
+                    # End-of-archive marker, padded to a full record as tarfile does.
+                    end = 2 * tarfile.BLOCKSIZE
+                    end += -(self._offset + end) % tarfile.RECORDSIZE
+                    self._write(tarfile.NUL * end)
+                    self._stream.close()  # ends the zstd frame
+            finally:
+                self._file.close()
+
+def next_archive_path(output_dir: pathlib.Path) -> pathlib.Path:
+    """Return ``<out>.tar.zst``, or ``<out>-N.tar.zst`` if earlier runs left archives."""
+    path = output_dir.with_name(f"{output_dir.name}.tar.zst")
+    n = 1
+    while path.exists():
+        path = output_dir.with_name(f"{output_dir.name}-{n}.tar.zst")
+        n += 1
+    return path
+
+def index_output_dir(output_dir: pathlib.Path) -> dict[str, str]:
+    """Map lower-cased file names in output_dir to their on-disk spelling."""
+    try:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with os.scandir(output_dir) as it:
+            return {e.name.lower(): e.name for e in it if e.is_file()}
+    except OSError as exc:
+        raise SystemExit(f"Failed to prepare output directory {output_dir}: {exc}") from exc
+
 def download_cif(
     material_id: str,
     output_dir: pathlib.Path,
+    existing: dict[str, str],
+    existing_lock: Lock,
     timeout: float,
     writer: Callable[[str], None],
+    bucket: TokenBucket | None = None,
+    archive: CifArchive | None = None,
 ) -> bool:
-    """Download a single CIF file; return True on success."""
-    url = BASE_URL.format(id=material_id)
+    """Download a single CIF file; return True on success.
+
+    ``existing`` is the shared index from :func:`index_output_dir`; it is
+    read and updated under ``existing_lock``. With ``archive`` the CIF is
+    added to it instead of being written to ``output_dir``.
+    """
+    url = _URL_PREFIX + material_id + _URL_SUFFIX
 
     def resolve_output_path() -> tuple[pathlib.Path, bool]:
         """Return a path to write. If exact-case file exists, mark skip."""
         target_name = f"{material_id}.cif"
-        target_lower = target_name.lower()
-        output_dir.mkdir(parents=True, exist_ok=True)
-        case_collision = False
-        if output_dir.exists():
-            for entry in output_dir.iterdir():
-                if not entry.is_file():
-                    continue
-                if entry.name.lower() != target_lower:
-                    continue
-                if entry.name == target_name:
-                    return entry, True  # exact-case exists
-                # same spelling but different case: pick a disambiguated name
-                case_collision = True
-                break
-        if not case_collision:
+        with existing_lock:
+            current = existing.get(target_name.lower())
+        if current is None:
             return output_dir / target_name, False
+        if current == target_name:
+            return output_dir / target_name, True  # exact-case exists
+        # same spelling but different case: pick a disambiguated name
         suffix = hashlib.sha1(material_id.encode("utf-8")).hexdigest()[:8]
         return output_dir / f"{material_id}__casefix-{suffix}.cif", False
 
-    output_path, already_exists = resolve_output_path()
-    if already_exists and output_path.exists():
-        writer(f"[skip] {material_id}: already exists at {output_path}")
-        return True
-    try:
-        with urllib.request.urlopen(url, timeout=timeout) as response:
-            if response.status != 200:
-                writer(f"[fail] {material_id}: HTTP {response.status}")
-                return False
-            data = response.read()
-    except urllib.error.HTTPError as exc:
-        writer(f"[fail] {material_id}: HTTP {exc.code} {exc.reason}")
-        return False
-    except urllib.error.URLError as exc:
-        writer(f"[fail] {material_id}: network error {exc.reason}")
-        return False
-    except TimeoutError:
-        writer(f"[fail] {material_id}: request timed out")
+    part_path: pathlib.Path | None = None
+    if archive is None:
+        output_path, already_exists = resolve_output_path()
+        if already_exists:
+            writer(f"[skip] {material_id}: already exists at {output_path}")
+            return True
+        # Stream into a sibling .part file and rename it into place, so an
+        # interrupted run never leaves a truncated .cif behind.
+        part_path = output_path.with_suffix(".cif.part")
+        destination = output_path
+    else:
+        destination = archive.path
+
+    def fail(message: str) -> bool:
+        if part_path is not None:
+            part_path.unlink(missing_ok=True)
+        writer(f"[fail] {material_id}: {message}")
         return False
+
+    if bucket:
+        bucket.acquire()
     try:
-        output_dir.mkdir(parents=True, exist_ok=True)
-        output_path.write_bytes(data)
+        with SESSION.get(url, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            if archive is not None:
+                data = b"".join(response.iter_content(chunk_size=CHUNK_SIZE))
+                archive.add(f"{material_id}.cif", data)
+            else:
+                length = response.headers.get("Content-Length", "")
+                with part_path.open("wb") as handle:
+                    preallocate(handle.fileno(), int(length) if length.isdigit() else 0)
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        handle.write(chunk)
+                    # Content-Length counts encoded bytes, so trim any unused reservation.
+                    handle.truncate()
+        if part_path is not None:
+            os.replace(part_path, output_path)
+            with existing_lock:
+                existing[output_path.name.lower()] = output_path.name
+    # requests exceptions subclass OSError, so they must be matched first.
+    except requests.HTTPError as exc:
+        response = exc.response
+        return fail(f"HTTP {response.status_code} {response.reason}")
+    except requests.Timeout:
+        return fail("request timed out")
+    except requests.RequestException as exc:
+        return fail(f"network error {exc}")
     except OSError as exc:
-        writer(f"[fail] {material_id}: unable to write file ({exc})")
-        return False
-    writer(f"[ok] {material_id}: saved to {output_path}")
+        return fail(f"unable to write file ({exc})")
+    writer(f"[ok] {material_id}: saved to {destination}")
     return True
 
 def parse_args(argv: list[str]) -> argparse.Namespace:
@@ -154,36 +346,120 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
         default=5,
         help="Number of CIFs to download in parallel (default: 5).",
     )
+    parser.add_argument(
+        "--rps",
+        type=float,
+        default=None,
+        help="Maximum download requests per second across all workers (default: unlimited).",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Write CIFs into a single zstd-compressed tar (<out>.tar.zst) instead of "
+        "individual files; requires the zstandard package.",
+    )
     return parser.parse_args(argv)
 
-def make_thread_safe_writer(base_writer: Callable[[str], None]) -> Callable[[str], None]:
-    """Wrap a writer so messages from multiple threads don't interleave."""
-    lock = Lock()
-    def safe_writer(message: str) -> None:
-        with lock:
-            base_writer(message)
-    return safe_writer
+def start_log_thread(base_writer: Callable[[str], None]) -> tuple[Callable[[str], None], Callable[[], None]]:
+    """Drain messages to base_writer on one daemon thread; return (writer, stop).
+
+    Workers only enqueue, so they never block on each other while printing.
+    """
+    log_q: queue.Queue[str | None] = queue.Queue()
+
+    def drain() -> None:
+        while True:
+            message = log_q.get()
+            try:
+                if message is None:
+                    return
+                try:
+                    base_writer(message)
+                except Exception:
+                    # Keep draining (e.g. BrokenPipeError when piped to head),
+                    # otherwise stop() would wait forever on log_q.join().
+                    try:
+                        print(message, file=sys.stderr)
+                    except Exception:
+                        pass
+            finally:
+                log_q.task_done()
+
+    thread = Thread(target=drain, name="download-log", daemon=True)
+    thread.start()
+
+    def stop() -> None:
+        log_q.join()
+        log_q.put(None)
+        thread.join()
+
+    return log_q.put, stop
 
 def main(argv: list[str]) -> int:
     args = parse_args(argv)
+    if args.compress and zstd is None:
+        raise SystemExit("--compress requires the zstandard package (pip install zstandard).")
     material_ids = iter_material_ids(args.ids)
-    log_rows: list[dict[str, str]] = load_log(args.log) if args.log else []
-    # Build quick index for updates; keeps earliest occurrence to preserve ordering.
+    log_rows: list[tuple[str, bool]] = load_log(args.log) if args.log else []
+    # Results are appended during a run, so later rows win; each ID keeps the
+    # position of its first occurrence to preserve ordering.
     index: dict[str, int] = {}
-    for i, row in enumerate(log_rows):
-        material_id = str(row.get("id", "")).strip()
-        if material_id and material_id not in index:
-            index[material_id] = i
-    previously_downloaded = {
-        mid for mid, idx in index.items()
-        if str(log_rows[idx].get("downloaded", "")).strip().lower() in {"true", "1", "yes", "y"}
-    }
+    compacted: list[tuple[str, bool]] = []
+    for row in log_rows:
+        material_id = row[0]
+        if material_id in index:
+            compacted[index[material_id]] = row
+            continue
+        if material_id:
+            index[material_id] = len(compacted)
+        compacted.append(row)
+    log_rows = compacted
+    previously_downloaded = {mid for mid, idx in index.items() if log_rows[idx][1]}
+
+    def record(material_id: str, success: bool) -> tuple[str, bool]:
+        row = (material_id, success)
+        if material_id in index:
+            log_rows[index[material_id]] = row  # overwrite previous entry
+        else:
+            index[material_id] = len(log_rows)
+            log_rows.append(row)
+        return row
+
     ids_to_process = [mid for mid in material_ids if mid not in previously_downloaded]
     if not ids_to_process:
         print("All listed materials are already downloaded according to the log.")
         return 0
+    # One directory snapshot decides which IDs already have their CIF, so
+    # workers are never scheduled (or stat anything) for them. In --compress
+    # mode earlier results live in previous archives and only the log counts.
+    existing = {} if args.compress else index_output_dir(args.out)
+    existing_lock = Lock()
+    on_disk = {
+        mid for mid in ids_to_process
+        if existing.get(f"{mid}.cif".lower()) == f"{mid}.cif"
+    }
+    downloaded = len(on_disk)
+    if on_disk:
+        print(f"Skipping {len(on_disk)} materials whose CIF already exists in {args.out}.")
+        ids_to_process = [mid for mid in ids_to_process if mid not in on_disk]
+        if args.log:
+            for material_id in on_disk:
+                record(material_id, True)
+    if not ids_to_process:
+        if args.log:
+            write_log(args.log, log_rows)
+        print(f"Completed: {downloaded}/{len(material_ids)} downloads succeeded.")
+        return 0
+    archive: CifArchive | None = None
+    if args.compress:
+        # A new archive per run: appending to a stream cut off by a crash
+        # would leave an unreadable frame in the middle.
+        archive_path = next_archive_path(args.out)
+        try:
+            archive = CifArchive(archive_path)
+        except OSError as exc:
+            raise SystemExit(f"Failed to create archive {archive_path}: {exc}") from exc
 
-    downloaded = 0
     if tqdm:
         pbar = tqdm(total=len(ids_to_process), desc="Downloading", unit="file")
         base_writer = pbar.write
@@ -194,36 +470,80 @@ def main(argv: list[str]) -> int:
         base_writer = print
         def bump():
             return None
-    writer = make_thread_safe_writer(base_writer)
+    writer, stop_log_thread = start_log_thread(base_writer)
+
+    # Append each result as it arrives so the CSV survives interruption; the
+    # full rewrite only happens once at shutdown to compact duplicate IDs.
+    # With --compress, rows wait in ``pending`` until the archive is flushed.
+    log_handle = open_log_appender(args.log) if args.log else None
+    log_writer = csv.writer(log_handle) if log_handle else None
+    pending: list[tuple[str, bool]] = []
+
+    def flush_archived() -> None:
+        """Append pending rows once the archive holds their CIFs on disk."""
+        if not archive.flush():
+            return
+        if log_writer:
+            log_writer.writerows(pending)
+            log_handle.flush()
+        pending.clear()
 
     max_workers = max(1, args.batch_size)
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_id = {
-            executor.submit(download_cif, material_id, args.out, args.timeout, writer): material_id
-            for material_id in ids_to_process
-        }
-        for future in as_completed(future_to_id):
-            material_id = future_to_id[future]
-            try:
-                success = future.result()
-            except Exception as exc:  # pragma: no cover - unexpected error
-                writer(f"[fail] {material_id}: unexpected error {exc}")
-                success = False
-            if success:
-                downloaded += 1
-                previously_downloaded.add(material_id)
-            if args.log:
-                row = {"id": material_id, "downloaded": str(success)}
-                if material_id in index:
-                    log_rows[index[material_id]] = row  # overwrite previous entry
-                else:
-                    index[material_id] = len(log_rows)
-                    log_rows.append(row)
-                write_log(args.log, log_rows)  # persist incrementally so CSV exists even if interrupted
-            bump()
-            if pbar is None:
-                delay = random.uniform(0.5, 1.0)
-                time.sleep(delay)
+    configure_session(max_workers)
+    bucket = TokenBucket(args.rps) if args.rps and args.rps > 0 else None
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_id = {
+                executor.submit(
+                    download_cif,
+                    material_id,
+                    args.out,
+                    existing,
+                    existing_lock,
+                    args.timeout,
+                    writer,
+                    bucket,
+                    archive,
+                ): material_id
+                for material_id in ids_to_process
+            }
+            for completed, future in enumerate(as_completed(future_to_id), start=1):
+                material_id = future_to_id[future]
+                try:
+                    success = future.result()
+                except Exception as exc:  # pragma: no cover - unexpected error
+                    writer(f"[fail] {material_id}: unexpected error {exc}")
+                    success = False
+                if success:
+                    downloaded += 1
+                    previously_downloaded.add(material_id)
+                if args.log:
+                    row = record(material_id, success)
+                    if archive is not None:
+                        pending.append(row)
+                        if completed % LOG_FLUSH_EVERY == 0:
+                            flush_archived()
+                    elif log_writer:
+                        log_writer.writerow(row)
+                        if completed % LOG_FLUSH_EVERY == 0:
+                            log_handle.flush()
+                bump()
+                if archive is not None and archive.error is not None:
+                    # Later entries would land after a torn one; stop here.
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+        if archive is not None and archive.error is None:
+            flush_archived()
+    finally:
+        stop_log_thread()
+        if log_handle:
+            log_handle.close()
+        if archive:
+            archive.close()
+    if archive is not None and archive.error is not None:
+        # Rows not covered by the last successful flush stay unlogged and are retried next run.
+        print(f"[fail] {archive.error}; stopped early.")
+        return 1
     if args.log:
         write_log(args.log, log_rows)
     print(f"Completed: {downloaded}/{len(material_ids)} downloads succeeded.")